@@ -1,12 +1,17 @@
-from flask import Flask, request, jsonify, send_file
+from flask import Flask, Response, request, send_file, stream_with_context
 from flask_cors import CORS
-import sqlite3, os, io, xlsxwriter
+from flask_caching import Cache
+from flask_compress import Compress
+import sqlite3, os, io, functools, queue, threading, time, orjson, xlsxwriter
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime
 from dotenv import load_dotenv
 
 # ===== Usuarios / seguridad =====
+import bcrypt, hmac, hashlib
 from itsdangerous import URLSafeTimedSerializer, BadSignature, SignatureExpired
-from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.security import check_password_hash
 
 # ===== OpenAI (opcional, ya lo usas) =====
 try:
@@ -18,13 +23,91 @@ load_dotenv()
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 SECRET_KEY = os.getenv("SECRET_KEY", "dev-secret-change-this")
 
+# Cliente OpenAI único: reusa el pool de conexiones httpx en vez de
+# pagar un handshake TCP+TLS por request
+_ai_client = OpenAI(api_key=OPENAI_API_KEY) if (OPENAI_API_KEY and OpenAI) else None
+
 # Firmador de tokens (confirmación)
 serializer = URLSafeTimedSerializer(SECRET_KEY)
 
+TOKEN_MAX_AGE = 172800  # 48 horas
+
+# Cache del parseo de tokens: re-verificar el mismo token repite HMAC +
+# base64 + JSON decode; el bucket por minuto hace expirar las entradas
+# para que max_age se siga respetando con resolución de 1 minuto.
+@functools.lru_cache(maxsize=8192)
+def _loads_cached(token, bucket):
+    return serializer.loads(token, max_age=TOKEN_MAX_AGE)
+
+def load_token(token):
+    return _loads_cached(token, int(time.time() // 60))
+
 app = Flask(__name__)
 CORS(app, resources={r"/api/*": {"origins": "*"}})
+# Cache de respuestas GET: los dashboards repiten summary/estado/
+# transactions cada pocos segundos con el mismo query string
+cache = Cache(app, config={'CACHE_TYPE': 'SimpleCache'})
+
+# Compresión br/gzip para los payloads JSON grandes (summary, estado).
+# Solo application/json: el XLSX ya es un zip y el SSE de ai_advice no
+# debe bufferearse. COMPRESS_STREAMS=False es clave: comprimir una
+# respuesta streaming obliga a materializarla entera (get_data()), lo
+# que anularía la memoria O(lote) del stream de /api/transactions.
+app.config['COMPRESS_ALGORITHM'] = ['br', 'gzip']
+app.config['COMPRESS_LEVEL'] = 4
+app.config['COMPRESS_MIN_SIZE'] = 1024
+app.config['COMPRESS_MIMETYPES'] = ['application/json']
+app.config['COMPRESS_STREAMS'] = False
+Compress(app)
+
+def ojsonify(obj, status=200):
+    # jsonify usa el json de la stdlib; orjson serializa 3-10x más
+    # rápido en payloads grandes como /api/transactions
+    return app.response_class(orjson.dumps(obj), status=status, mimetype='application/json')
 
 DB = 'pymax.db'
+POOL_SIZE = int(os.getenv('DB_POOL_SIZE', '4'))
+
+
+# ====== DB: conexiones (1 escritor + N lectores) ======
+# Reusar conexiones evita pagar open()/close() y perder el page cache de
+# SQLite en cada request. Bajo WAL los lectores no bloquean al escritor
+# ni entre sí, así que las lecturas van a un pool de conexiones mode=ro
+# y las escrituras a una única conexión serializada con un Lock.
+_writer = None
+_writer_lock = threading.Lock()
+_readers = queue.Queue(maxsize=POOL_SIZE)
+
+def _new_conn(readonly=False):
+    # cache=shared: todas las conexiones comparten un solo page cache,
+    # así una lectura caliente en una conexión sirve a las demás
+    uri = f'file:{DB}?cache=shared' + ('&mode=ro' if readonly else '')
+    conn = sqlite3.connect(uri, uri=True, check_same_thread=False, isolation_level=None)
+    # Row permite dict(row) por la vía C, sin zip() por fila en Python
+    conn.row_factory = sqlite3.Row
+    if readonly:
+        conn.execute('PRAGMA read_uncommitted=1')
+    else:
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute('PRAGMA cache_size=-64000')
+    conn.execute('PRAGMA temp_store=memory')
+    return conn
+
+@contextmanager
+def get_conn(write=False):
+    if write:
+        with _writer_lock:
+            try:
+                yield _writer
+            finally:
+                _writer.execute('PRAGMA optimize')
+    else:
+        conn = _readers.get()
+        try:
+            yield conn
+        finally:
+            _readers.put(conn)
 
 
 # ====== DB: inicialización ======
@@ -44,8 +127,12 @@ def init_db():
       )
     ''')
     # índices
-    c.execute('CREATE INDEX IF NOT EXISTS idx_tx_date ON transactions(date)')
-    c.execute('CREATE INDEX IF NOT EXISTS idx_tx_type ON transactions(type)')
+    # índice cubriente: summary/estado/export se resuelven solo con el
+    # índice; los índices simples viejos solo encarecían los INSERT
+    # (type por sí solo tiene cardinalidad bajísima)
+    c.execute('CREATE INDEX IF NOT EXISTS idx_tx_date_type_amount ON transactions(date, type, amount)')
+    c.execute('DROP INDEX IF EXISTS idx_tx_date')
+    c.execute('DROP INDEX IF EXISTS idx_tx_type')
 
     # usuarios (nuevo)
     c.execute('''
@@ -59,35 +146,114 @@ def init_db():
       )
     ''')
     c.execute('CREATE INDEX IF NOT EXISTS idx_users_email ON users(email)')
+    c.execute('ANALYZE')
     conn.commit()
     conn.close()
+    # el escritor se abre primero (activa WAL); después los lectores
+    global _writer
+    _writer = _new_conn()
+    while not _readers.full():
+        _readers.put(_new_conn(readonly=True))
 
 init_db()
 
 
+# ====== SQL (constantes de módulo) ======
+# El pool reusa conexiones, así que el statement cache interno de SQLite
+# acierta en cada request; mantener los strings como constantes evita
+# además reconstruir el literal en cada llamada.
+SQL_INSERT_TX = 'INSERT INTO transactions (date,type,category,amount,client,note) VALUES (?,?,?,?,?,?)'
+SQL_SEL_TX_BY_DATE = 'SELECT id,date,type,category,amount,client,note FROM transactions WHERE date=? ORDER BY id DESC'
+SQL_SEL_TX_RECENT = 'SELECT id,date,type,category,amount,client,note FROM transactions ORDER BY date DESC, id DESC LIMIT 1000'
+SQL_TOTALS = '''
+    SELECT COALESCE(SUM(CASE WHEN type='venta' THEN amount ELSE 0 END),0),
+           COALESCE(SUM(CASE WHEN type='compra' THEN amount ELSE 0 END),0),
+           COALESCE(SUM(CASE WHEN type='gasto' THEN amount ELSE 0 END),0)
+    FROM transactions WHERE '''
+SQL_SUMMARY = SQL_TOTALS + 'date=?'
+SQL_ESTADO = SQL_TOTALS + 'date BETWEEN ? AND ?'
+SQL_EXPORT = 'SELECT date,type,category,amount,client,note FROM transactions WHERE date BETWEEN ? AND ? ORDER BY date, id'
+SQL_SEL_USER_BY_EMAIL = 'SELECT id,name,password_hash,confirmed FROM users WHERE email=?'
+
+
 # ====== Helpers DB ======
 def db_execute(query, params=()):
-    conn = sqlite3.connect(DB)
-    c = conn.cursor()
-    c.execute(query, params)
-    conn.commit()
-    last = c.lastrowid
-    conn.close()
-    return last
+    with get_conn(write=True) as conn:
+        cur = conn.execute(query, params)
+        conn.commit()
+        return cur.lastrowid
 
 def db_query(query, params=()):
-    conn = sqlite3.connect(DB)
-    c = conn.cursor()
-    c.execute(query, params)
-    rows = c.fetchall()
-    conn.close()
-    return rows
+    with get_conn() as conn:
+        return conn.execute(query, params).fetchall()
+
+def db_iter(query, params=(), batch=1000):
+    # Genera lotes de filas sin materializar todo el resultado.
+    # La conexión queda tomada del pool hasta agotar el cursor.
+    with get_conn() as conn:
+        cur = conn.execute(query, params)
+        while True:
+            rows = cur.fetchmany(batch)
+            if not rows:
+                break
+            yield rows
 
 
 # =========================================================
 # ===============  MÓDULO: USUARIOS  ======================
 # =========================================================
 
+# Hash de passwords: bcrypt (más resistente a GPU que pbkdf2, permite
+# bajar el costo por login). Los hashes pbkdf2 de Werkzeug que ya están
+# en la tabla se siguen verificando con check_password_hash.
+BCRYPT_ROUNDS = 12
+
+# El hash cuesta ~100-300 ms de CPU; ejecutarlo en el thread del request
+# bloquea al resto de los usuarios. Se despacha a un pool de procesos
+# (creado perezosamente) y el thread solo espera el resultado.
+_HASH_POOL = None
+_hash_pool_lock = threading.Lock()
+
+def _hash_pool():
+    global _HASH_POOL
+    if _HASH_POOL is None:
+        with _hash_pool_lock:
+            if _HASH_POOL is None:
+                _HASH_POOL = ProcessPoolExecutor(max_workers=min(4, os.cpu_count() or 1))
+    return _HASH_POOL
+
+def _bcrypt_hash(password):
+    # corre en el proceso worker
+    return bcrypt.hashpw(password.encode(), bcrypt.gensalt(rounds=BCRYPT_ROUNDS)).decode()
+
+def _check_hash(phash, password):
+    # corre en el proceso worker
+    if phash.startswith('$2'):
+        return bcrypt.checkpw(password.encode(), phash.encode())
+    return check_password_hash(phash, password)  # hashes pbkdf2 legados
+
+def _hash_password(password):
+    return _hash_pool().submit(_bcrypt_hash, password).result()
+
+# Cache LRU de verificaciones positivas: la clave es (hash, HMAC del
+# password) para no retener plaintext en memoria. Re-logins repetidos
+# se vuelven O(1) en lugar de re-ejecutar bcrypt; al llenarse se
+# evicta la entrada menos usada (el dict conserva orden de inserción).
+_VERIFY_CACHE_MAX = 4096
+_verify_cache = {}
+
+def _verify_password(phash, password):
+    key = (phash, hmac.new(SECRET_KEY.encode(), password.encode(), hashlib.sha256).digest())
+    if key in _verify_cache:
+        _verify_cache[key] = _verify_cache.pop(key)  # refresca recencia
+        return True
+    ok = _hash_pool().submit(_check_hash, phash, password).result()
+    if ok:
+        while len(_verify_cache) >= _VERIFY_CACHE_MAX:
+            _verify_cache.pop(next(iter(_verify_cache)))
+        _verify_cache[key] = True
+    return ok
+
 # POST /api/register  -> crea usuario (no confirmado) y devuelve confirm_url
 @app.route('/api/register', methods=['POST'])
 def register():
@@ -97,30 +263,32 @@ def register():
     password = (data.get('password') or '').strip()
 
     if not name or not email or not password:
-        return jsonify({'error': 'name, email y password son requeridos'}), 400
-
-    # existe?
-    existing = db_query('SELECT id FROM users WHERE email=?', (email,))
-    if existing:
-        return jsonify({'error': 'El email ya está registrado'}), 409
+        return ojsonify({'error': 'name, email y password son requeridos'}), 400
 
     # hash
-    ph = generate_password_hash(password)
+    ph = _hash_password(password)
     now = datetime.utcnow().isoformat(timespec='seconds')
 
+    # un solo round trip: el UNIQUE(email) decide, sin SELECT previo
+    # ni carrera entre chequeo e insert
     try:
-        db_execute(
-            'INSERT INTO users (name,email,password_hash,confirmed,created_at) VALUES (?,?,?,?,?)',
-            (name, email, ph, 0, now)
-        )
+        with get_conn(write=True) as conn:
+            row = conn.execute(
+                'INSERT INTO users (name,email,password_hash,confirmed,created_at) VALUES (?,?,?,?,?) '
+                'ON CONFLICT(email) DO NOTHING RETURNING id',
+                (name, email, ph, 0, now)
+            ).fetchone()
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return ojsonify({'error': str(e)}), 500
+
+    if row is None:
+        return ojsonify({'error': 'El email ya está registrado'}), 409
 
     # token firmado (expira a las 48h, se valida en /api/confirm)
     token = serializer.dumps({'email': email})
     # NO construimos aquí el dominio (lo arma el front con tu BASE_URL),
     # pero por conveniencia devolvemos solo el token:
-    return jsonify({
+    return ojsonify({
         'message': 'Usuario creado. Enviar email de confirmación.',
         'token': token
     }), 201
@@ -131,27 +299,25 @@ def register():
 def confirm():
     token = request.args.get('token', '').strip()
     if not token:
-        return jsonify({'error': 'token requerido'}), 400
+        return ojsonify({'error': 'token requerido'}), 400
 
     try:
-        data = serializer.loads(token, max_age=172800)  # 48 horas
+        data = load_token(token)
         email = (data.get('email') or '').lower()
     except SignatureExpired:
-        return jsonify({'error': 'Token expirado'}), 400
+        return ojsonify({'error': 'Token expirado'}), 400
     except BadSignature:
-        return jsonify({'error': 'Token inválido'}), 400
-
-    # marcar confirmado
-    rows = db_query('SELECT id,confirmed FROM users WHERE email=?', (email,))
-    if not rows:
-        return jsonify({'error': 'Usuario no encontrado'}), 404
+        return ojsonify({'error': 'Token inválido'}), 400
 
-    uid, confirmed = rows[0]
-    if confirmed:
-        return jsonify({'message': 'Cuenta ya estaba confirmada'}), 200
-
-    db_execute('UPDATE users SET confirmed=1 WHERE id=?', (uid,))
-    return jsonify({'message': 'Cuenta confirmada correctamente'}), 200
+    # marcar confirmado: un solo UPDATE ... RETURNING flipea el bit y
+    # reporta si había algo que flipear (sin ventana SELECT/UPDATE)
+    with get_conn(write=True) as conn:
+        row = conn.execute('UPDATE users SET confirmed=1 WHERE email=? AND confirmed=0 RETURNING id', (email,)).fetchone()
+        if row:
+            return ojsonify({'message': 'Cuenta confirmada correctamente'}), 200
+        if conn.execute('SELECT 1 FROM users WHERE email=?', (email,)).fetchone():
+            return ojsonify({'message': 'Cuenta ya estaba confirmada'}), 200
+    return ojsonify({'error': 'Usuario no encontrado'}), 404
 
 
 # POST /api/login  -> valida credenciales y confirmación
@@ -162,32 +328,54 @@ def login():
     password = (data.get('password') or '').strip()
 
     if not email or not password:
-        return jsonify({'error': 'email y password son requeridos'}), 400
+        return ojsonify({'error': 'email y password son requeridos'}), 400
 
-    rows = db_query('SELECT id,name,password_hash,confirmed FROM users WHERE email=?', (email,))
+    rows = db_query(SQL_SEL_USER_BY_EMAIL, (email,))
     if not rows:
-        return jsonify({'error': 'Credenciales inválidas'}), 401
+        return ojsonify({'error': 'Credenciales inválidas'}), 401
 
     uid, name, phash, confirmed = rows[0]
-    if not check_password_hash(phash, password):
-        return jsonify({'error': 'Credenciales inválidas'}), 401
+    if not _verify_password(phash, password):
+        return ojsonify({'error': 'Credenciales inválidas'}), 401
 
     if not confirmed:
-        return jsonify({'error': 'Correo no confirmado'}), 403
+        return ojsonify({'error': 'Correo no confirmado'}), 403
 
     # (Opcional) generar un token de sesión simple firmado
     session_token = serializer.dumps({'uid': uid, 'email': email})
-    return jsonify({'message': 'ok', 'name': name, 'email': email, 'session_token': session_token})
+    return ojsonify({'message': 'ok', 'name': name, 'email': email, 'session_token': session_token})
 
 
 # =========================================================
 # =========  TUS ENDPOINTS FINANCIEROS EXISTENTES  =========
 # =========================================================
 
-# Agregar transacción
+# Agregar transacción (objeto) o lote de transacciones (lista)
 @app.route('/api/transaction', methods=['POST'])
 def add_transaction():
     data = request.get_json()
+
+    # lote: un solo BEGIN/COMMIT amortiza el fsync sobre N filas
+    if isinstance(data, list):
+        params = []
+        for r in data:
+            if not r.get('date') or not r.get('type'):
+                return ojsonify({'error':'date y type requeridos'}), 400
+            params.append((r['date'], r['type'], r.get('category','General'),
+                           float(r.get('amount',0)), r.get('client',''), r.get('note','')))
+        if not params:
+            return ojsonify({'error':'lista vacía'}), 400
+        with get_conn(write=True) as conn:
+            conn.execute('BEGIN')
+            try:
+                conn.executemany(SQL_INSERT_TX, params)
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+        cache.clear()
+        return ojsonify({'message':'ok', 'inserted': len(params)}), 201
+
     date = data.get('date')
     typ = data.get('type')
     category = data.get('category','General')
@@ -196,43 +384,112 @@ def add_transaction():
     note = data.get('note','')
     # Validación simple
     if not date or not typ:
-        return jsonify({'error':'date y type requeridos'}), 400
-    db_execute('INSERT INTO transactions (date,type,category,amount,client,note) VALUES (?,?,?,?,?,?)',
-               (date,typ,category,amount,client,note))
-    return jsonify({'message':'ok'}), 201
+        return ojsonify({'error':'date y type requeridos'}), 400
+    db_execute(SQL_INSERT_TX, (date,typ,category,amount,client,note))
+    # las vistas cacheadas quedan obsoletas al escribir
+    cache.clear()
+    return ojsonify({'message':'ok'}), 201
+
+# ETag barato para los endpoints de lectura: una sonda index-only sobre
+# MAX(id)/COUNT(*) detecta cualquier alta o baja sin correr la query
+# completa; si el cliente ya tiene esa versión respondemos 304.
+def _tx_etag(where='', params=()):
+    row = db_query('SELECT IFNULL(MAX(id),0), COUNT(*) FROM transactions' + where, params)[0]
+    return f'W/"{row[0]}-{row[1]}"'
+
+def _etag_match(etag):
+    # Flask-Compress reescribe el ETag saliente a W/"...:br" / ":gzip"
+    # cuando comprime el body, así que el validador que el cliente
+    # devuelve trae ese sufijo: hay que quitarlo antes de comparar
+    header = request.headers.get('If-None-Match')
+    if not header:
+        return False
+    for suf in (':br"', ':gzip"', ':deflate"'):
+        header = header.replace(suf, '"')
+    return etag in (v.strip() for v in header.split(','))
+
+def _cache_200(resp):
+    # no cachear 304/errores: un 304 cacheado se serviría a clientes
+    # que mandaron el request sin If-None-Match
+    return getattr(resp, 'status_code', 200) == 200
+
+def _tx_revalidate(view):
+    # se aplica POR ENCIMA de cache.cached: el validador tiene que
+    # consultarse antes del lookup del cache, si no un cache caliente
+    # devuelve 200 completos durante toda la ventana y el 304 no corre
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        date = request.args.get('date')
+        if not date:
+            return view(*args, **kwargs)
+        etag = _tx_etag(' WHERE date=?', (date,))
+        if _etag_match(etag):
+            return Response(status=304)
+        resp = view(*args, **kwargs)
+        if getattr(resp, 'status_code', None) == 200:
+            resp.headers['ETag'] = etag
+        return resp
+    return wrapper
+
+
+# Obtener transacciones (respuesta streaming: memoria O(lote), el
+# cliente empieza a parsear antes de que termine el servidor)
+def _stream_tx(query, params=()):
+    # conexión propia, NO del pool: la vida de esta conexión queda atada
+    # al ritmo de descarga del cliente, y unos pocos clientes lentos no
+    # deben dejar sin lectores al resto del proceso
+    conn = _new_conn(readonly=True)
+    try:
+        cur = conn.execute(query, params)
+        yield b'['
+        first = True
+        while True:
+            batch = cur.fetchmany(500)
+            if not batch:
+                break
+            for row in batch:
+                prefix = b'' if first else b','
+                first = False
+                yield prefix + orjson.dumps(dict(row))
+        yield b']'
+    finally:
+        conn.close()
 
-# Obtener transacciones
 @app.route('/api/transactions', methods=['GET'])
 def get_transactions():
     date = request.args.get('date')
+    etag = _tx_etag(' WHERE date=?', (date,)) if date else _tx_etag()
+    if _etag_match(etag):
+        return Response(status=304)
     if date:
-        rows = db_query('SELECT id,date,type,category,amount,client,note FROM transactions WHERE date=? ORDER BY id DESC', (date,))
+        gen = _stream_tx(SQL_SEL_TX_BY_DATE, (date,))
     else:
-        rows = db_query('SELECT id,date,type,category,amount,client,note FROM transactions ORDER BY date DESC, id DESC LIMIT 1000')
-    cols = ['id','date','type','category','amount','client','note']
-    data = [dict(zip(cols,row)) for row in rows]
-    return jsonify(data)
+        gen = _stream_tx(SQL_SEL_TX_RECENT)
+    resp = Response(stream_with_context(gen), mimetype='application/json')
+    resp.headers['ETag'] = etag
+    return resp
 
 # Resumen por fecha
 @app.route('/api/summary', methods=['GET'])
+@_tx_revalidate
+@cache.cached(timeout=30, query_string=True, response_filter=_cache_200)
 def summary():
     date = request.args.get('date')
-    if not date: return jsonify({'error':'date required'}), 400
-    rows = db_query('SELECT type, SUM(amount) FROM transactions WHERE date=? GROUP BY type',(date,))
-    res = {r[0]: r[1] for r in rows}
-    ventas = res.get('venta',0); compras = res.get('compra',0); gastos=res.get('gasto',0)
+    if not date: return ojsonify({'error':'date required'}), 400
+    row = db_query(SQL_SUMMARY, (date,))[0]
+    ventas, compras, gastos = row
     utilidad = ventas - (compras + gastos)
-    return jsonify({'ventas':ventas,'compras':compras,'gastos':gastos,'utilidad':utilidad})
+    return ojsonify({'ventas':ventas,'compras':compras,'gastos':gastos,'utilidad':utilidad})
 
 # Estado de Resultados
 @app.route('/api/estado', methods=['GET'])
+@cache.cached(timeout=30, query_string=True)
 def estado():
     start = request.args.get('start')
     end = request.args.get('end')
-    if not start or not end: return jsonify({'error':'start and end required'}), 400
-    rows = db_query('SELECT type, SUM(amount) FROM transactions WHERE date BETWEEN ? AND ? GROUP BY type', (start, end))
-    res = {r[0]: r[1] for r in rows}
-    ventas = res.get('venta',0); compras = res.get('compra',0); gastos=res.get('gasto',0)
+    if not start or not end: return ojsonify({'error':'start and end required'}), 400
+    row = db_query(SQL_ESTADO, (start, end))[0]
+    ventas, compras, gastos = row
     utilidad_bruta = ventas - compras
     utilidad_neta = utilidad_bruta - gastos
     impuesto_estimado = utilidad_neta * 0.25 if utilidad_neta>0 else 0
@@ -240,22 +497,30 @@ def estado():
       'ventas':ventas,'compras':compras,'gastos':gastos,
       'utilidad_bruta':utilidad_bruta,'utilidad_neta':utilidad_neta,'impuesto_estimado':impuesto_estimado
     }
-    return jsonify(estado)
+    return ojsonify(estado)
 
 # Exportar Excel
 @app.route('/api/export', methods=['GET'])
 def export():
     start = request.args.get('start'); end = request.args.get('end')
-    if not start or not end: return jsonify({'error':'start and end required'}), 400
-    rows = db_query('SELECT date,type,category,amount,client,note FROM transactions WHERE date BETWEEN ? AND ? ORDER BY date, id', (start,end))
+    if not start or not end: return ojsonify({'error':'start and end required'}), 400
     output = io.BytesIO()
-    workbook = xlsxwriter.Workbook(output, {'in_memory': True})
+    # constant_memory vacía cada fila al zip apenas se escribe: RSS O(1)
+    # en vez de O(filas) para rangos grandes. Ojo: no combinar con
+    # in_memory, xlsxwriter lo desactiva silenciosamente en ese caso
+    workbook = xlsxwriter.Workbook(output, {'constant_memory': True})
     ws = workbook.add_worksheet('Transacciones')
+    # formato registrado una vez a nivel columna: no se re-resuelve
+    # por celda en el loop de escritura
+    money_fmt = workbook.add_format({'num_format': '#,##0.00'})
+    ws.set_column(3, 3, 12, money_fmt)
     headers = ['Fecha','Tipo','Categoria','Importe','Cliente','Nota']
-    for c, h in enumerate(headers): ws.write(0,c,h)
-    for r, row in enumerate(rows, start=1):
-        for c, val in enumerate(row):
-            ws.write(r,c,val)
+    ws.write_row(0, 0, headers)
+    r = 1
+    for rows in db_iter(SQL_EXPORT, (start,end)):
+        for row in rows:
+            ws.write_row(r, 0, row)
+            r += 1
     workbook.close()
     output.seek(0)
     filename = f"Transacciones_{start}_to_{end}.xlsx"
@@ -264,26 +529,45 @@ def export():
 # IA (opcional)
 @app.route('/api/ai_advice', methods=['POST'])
 def ai_advice():
-    if not OPENAI_API_KEY or not OpenAI:
-        return jsonify({'error':'AI not configured on server'}), 500
-    client = OpenAI(api_key=OPENAI_API_KEY)
+    if _ai_client is None:
+        return ojsonify({'error':'AI not configured on server'}), 500
     payload = request.get_json() or {}
     prompt = payload.get('prompt','').strip()
-    if not prompt: return jsonify({'error':'prompt is required'}), 400
+    if not prompt: return ojsonify({'error':'prompt is required'}), 400
+    messages = [
+        {"role":"system","content":"Eres un asesor contable y financiero profesional."},
+        {"role":"user","content": prompt}
+    ]
+    # stream=true en el payload -> SSE: los tokens salen a medida que
+    # el modelo genera, en vez de esperar la respuesta completa
+    if payload.get('stream'):
+        def _sse():
+            resp = _ai_client.chat.completions.create(
+                model="gpt-4o-mini", messages=messages, max_tokens=800, stream=True)
+            for chunk in resp:
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    yield f"data: {orjson.dumps({'delta': delta}).decode()}\n\n"
+            yield "data: [DONE]\n\n"
+        return Response(stream_with_context(_sse()), mimetype='text/event-stream')
     try:
-        resp = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[
-                {"role":"system","content":"Eres un asesor contable y financiero profesional."},
-                {"role":"user","content": prompt}
-            ],
-            max_tokens=800
-        )
+        resp = _ai_client.chat.completions.create(
+            model="gpt-4o-mini", messages=messages, max_tokens=800)
         text = resp.choices[0].message.content
-        return jsonify({'answer': text})
+        return ojsonify({'answer': text})
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return ojsonify({'error': str(e)}), 500
+
+# ===== ASGI =====
+# Punto de entrada para uvicorn (ver procfile): los handlers son sync
+# pero uvicorn los ejecuta en su threadpool, así que requests I/O-bound
+# (OpenAI, SQLite) no bloquean el loop ni se serializan entre sí.
+try:
+    from asgiref.wsgi import WsgiToAsgi
+    asgi_app = WsgiToAsgi(app)
+except ImportError:
+    asgi_app = None
 
 # ===== Main =====
 if __name__ == '__main__':
-    app.run(debug=True, port=5000)
+    app.run(debug=False, port=5000, threaded=True)